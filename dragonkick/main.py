@@ -9,26 +9,26 @@ A simple colorful tool to kickstart Ghidra projects from the command line.
 """
 
 import argparse
-import cle
-import git
 import glob
 import io
+import itertools
+import multiprocessing
 import os
-import pyghidra
 import shutil
+import stat
+import struct
 import subprocess
 import sys
+import threading
 import zipfile
+import zlib
 
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import contextmanager
 from importlib.metadata import metadata
 from pathlib import Path
-from rich.console import Console, Group
-from rich.live import Live
-from rich.panel import Panel
-from rich.progress import Progress, TextColumn, BarColumn, SpinnerColumn, TimeElapsedColumn, MofNCompleteColumn
-from rich.status import Status
-from typing import TYPE_CHECKING, List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 if TYPE_CHECKING:
     from ghidra.ghidra_builtins import *
@@ -41,20 +41,45 @@ EX_SOFTWARE = 70
 EX_CANTCREAT = 73
 EX_IOERR = 74
 
+ZIP_CHUNK_SIZE = 1024 * 1024
 
-console = Console(file=sys.__stdout__, log_path=False)
+# Archive comment recording the deflate level of the project zip entries
+ZIP_LEVEL_COMMENT = b"dragonkick zip level %d"
+
+
+class LazyConsole:
+    # rich is only imported once something gets printed, keeping --help and
+    # --version fast
+    _console = None
+
+    def __getattr__(self, name):
+        if self._console is None:
+            from rich.console import Console
+            self._console = Console(file=sys.__stdout__, log_path=False)
+        return getattr(self._console, name)
+
+
+console = LazyConsole()
 
 
 def SetupDecompiler(program):
-    from ghidra.app.decompiler import DecompInterface
+    from ghidra.app.decompiler import DecompileOptions, DecompInterface
+
+    options = DecompileOptions()
+    options.grabFromProgram(program)
 
     decomp = DecompInterface()
+    decomp.setOptions(options)
+    # Only the C code is used, skip sending back the syntax tree
+    decomp.toggleCCode(True)
+    decomp.toggleSyntaxTree(False)
+    decomp.setSimplificationStyle("decompile")
     decomp.openProgram(program)
 
     return decomp
 
 
-def DecompileFunction(function, decompiler, timeout: int = 0, monitor=None) -> List:
+def DecompileFunction(function, decompiler, timeout: int = 60, monitor=None) -> List:
     from ghidra.util.task import ConsoleTaskMonitor
 
     if monitor is None:
@@ -72,6 +97,38 @@ def DecompileFunction(function, decompiler, timeout: int = 0, monitor=None) -> L
     return [function, signature, code, f"{function.getEntryPoint()}.c", f"{function.getEntryPoint()}::{function}.c"]
 
 
+def DecompileFunctions(program, functions, on_decompiled, timeout: int = 60, monitor=None) -> None:
+    from ghidra.app.decompiler.parallel import ParallelDecompiler
+    from ghidra.util.task import ConsoleTaskMonitor
+    from jpype import JImplements, JOverride
+
+    if monitor is None:
+        monitor = ConsoleTaskMonitor()
+
+    # ParallelDecompiler runs the callback from a pool of worker threads,
+    # each worker gets its own decompiler process
+    decompilers = []
+    local = threading.local()
+
+    @JImplements("generic.concurrent.QCallback")
+    class DecompileCallback:
+        @JOverride
+        def process(self, function, monitor):
+            if not hasattr(local, "decompiler"):
+                local.decompiler = SetupDecompiler(program)
+                decompilers.append(local.decompiler)
+
+            on_decompiled(DecompileFunction(
+                function, local.decompiler, timeout, monitor))
+
+    try:
+        ParallelDecompiler.decompileFunctions(
+            DecompileCallback(), functions, monitor)
+    finally:
+        for decompiler in decompilers:
+            decompiler.dispose()
+
+
 def SetFunctionComment(function, comment, listing):
     from ghidra.program.model.listing import CodeUnit
 
@@ -79,7 +136,114 @@ def SetFunctionComment(function, comment, listing):
                        CodeUnit.PLATE_COMMENT, comment)
 
 
-def ZipProject(project_dir: Path, project_name: str) -> Path:
+def CompressZipEntry(path: str, arcname: str, compression: int, compresslevel: Optional[int]) -> Tuple[zipfile.ZipInfo, Optional[List[bytes]]]:
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    zinfo.file_size = 0
+    zinfo.CRC = 0
+
+    if zinfo.is_dir():
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.compress_size = 0
+        return zinfo, []
+
+    zinfo.compress_type = compression
+    if compression == zipfile.ZIP_DEFLATED:
+        # Raw deflate stream, same as zipfile's own compressor
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        chunks = []
+    else:
+        # Stored data is copied straight from the file by WriteZipEntry
+        compressor = None
+        chunks = None
+
+    with open(path, "rb", buffering=0) as fh:
+        while True:
+            chunk = fh.read(ZIP_CHUNK_SIZE)
+            if not chunk:
+                break
+            zinfo.file_size += len(chunk)
+            zinfo.CRC = zlib.crc32(chunk, zinfo.CRC)
+            if compressor is not None:
+                chunks.append(compressor.compress(chunk))
+
+    if compressor is not None:
+        chunks.append(compressor.flush())
+        zinfo.compress_size = sum(len(x) for x in chunks)
+    else:
+        zinfo.compress_size = zinfo.file_size
+
+    return zinfo, chunks
+
+
+def SendFileData(src, dst, offset: int, count: int) -> None:
+    try:
+        # Zero-copy, the data never goes through user space
+        while count > 0:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset, count)
+            if sent == 0:
+                break
+            offset += sent
+            count -= sent
+    except (AttributeError, OSError):
+        # No sendfile() between regular files on this platform
+        dst.seek(0, os.SEEK_END)
+        src.seek(offset)
+        while count > 0:
+            chunk = src.read(min(count, ZIP_CHUNK_SIZE))
+            if not chunk:
+                break
+            dst.write(chunk)
+            count -= len(chunk)
+
+    if count > 0:
+        raise EOFError(f"{src.name} ended {count} bytes early")
+
+
+def WriteZipEntry(zipf: zipfile.ZipFile, zinfo: zipfile.ZipInfo, chunks: Optional[List[bytes]], source: Optional[str] = None, offset: int = 0) -> None:
+    # Append an already compressed entry, either from memory or copied from
+    # source at offset. The central directory is written by zipf.close()
+    # from the bookkeeping below
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+
+    if chunks is None:
+        zipf.fp.flush()
+        with open(source, "rb") as fh:
+            SendFileData(fh, zipf.fp, offset, zinfo.compress_size)
+        # Data may have been written behind the file object's back
+        zipf.fp.seek(0, os.SEEK_END)
+    else:
+        for chunk in chunks:
+            zipf.fp.write(chunk)
+
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+    zipf.start_dir = zipf.fp.tell()
+
+
+def ZipEntryDataOffset(zipf: zipfile.ZipFile, zinfo: zipfile.ZipInfo) -> int:
+    # Where the entry data starts in the archive, right after its local header
+    zipf.fp.seek(zinfo.header_offset)
+    header = zipf.fp.read(zipfile.sizeFileHeader)
+    if header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {zinfo.filename}")
+
+    filename_length, extra_length = struct.unpack("<HH", header[26:30])
+
+    return zinfo.header_offset + zipfile.sizeFileHeader + filename_length + extra_length
+
+
+def DosDateTime(date_time: Tuple[int, ...]) -> Tuple[int, ...]:
+    # Zip timestamps only store seconds with a 2 seconds resolution
+    return date_time[:5] + (date_time[5] // 2 * 2,)
+
+
+def ZipProject(project_dir: Path, project_name: str, compresslevel: int = 1, rezip: bool = False) -> Path:
+    from rich.console import Group
+    from rich.live import Live
+    from rich.panel import Panel
+    from rich.progress import Progress, TextColumn, BarColumn, SpinnerColumn, TimeElapsedColumn, MofNCompleteColumn
+
     if not project_dir.is_dir():
         raise ValueError(f"'{project_dir}' is not a valid project directory.")
 
@@ -93,19 +257,96 @@ def ZipProject(project_dir: Path, project_name: str) -> Path:
     progress_panel = Panel(progress)
     live_group = Group(progress_panel)
 
-    with Live(live_group, refresh_per_second=10) as live:
+    with Live(live_group, refresh_per_second=10, auto_refresh=console.is_terminal) as live:
         project_zip = project_dir.parent / f"{project_name}.zip"
+        partial_zip = project_zip.with_name(f"{project_zip.name}.part")
+        level_comment = ZIP_LEVEL_COMMENT % compresslevel
 
-        with zipfile.ZipFile(project_zip, "w", zipfile.ZIP_DEFLATED) as zipf:
-            project_files = [x for x in project_dir.rglob("*")]
-            task = progress.add_task(
-                "[green]Zipping project directory...", total=len(project_files))
-            for file in project_files:
-                arcname = file.relative_to(project_dir)
-                zipf.write(file, arcname)
-                progress.update(
-                    task, description=f"[green]Added {file.name} to {project_zip.name}")
-                progress.update(task, advance=1)
+        if compresslevel == 0:
+            compression = zipfile.ZIP_STORED
+            compresslevel = None
+        else:
+            compression = zipfile.ZIP_DEFLATED
+
+        # Entries of unchanged files are copied over from the previous zip
+        # without compressing them again
+        previous_zip = None
+        previous_entries = {}
+        reuse_deflated = False
+        if project_zip.is_file() and not rezip:
+            try:
+                previous_zip = zipfile.ZipFile(project_zip)
+                previous_entries = previous_zip.NameToInfo
+                # Deflated data is only as good as the level it was written
+                # at, which is unknown for zips without the comment
+                reuse_deflated = previous_zip.comment == level_comment
+            except zipfile.BadZipFile:
+                log_warning(f"Rebuilding invalid project zip {project_zip}")
+
+        try:
+            with zipfile.ZipFile(partial_zip, "w", compression, compresslevel=compresslevel) as zipf:
+                zipf.comment = level_comment
+                project_files = []
+                for dirpath, dirnames, filenames in os.walk(project_dir):
+                    if not dirnames and not filenames and dirpath != str(project_dir):
+                        # Parent directories are implied by their files, only
+                        # empty ones need an entry of their own
+                        project_files.append(dirpath)
+                    for name in filenames:
+                        project_files.append(os.path.join(dirpath, name))
+
+                task = progress.add_task(
+                    "[green]Zipping project directory...", total=len(project_files))
+
+                def write_entry(entry):
+                    future, source, offset = entry
+                    zinfo, chunks = future.result()
+                    WriteZipEntry(zipf, zinfo, chunks, source, offset)
+                    progress.update(
+                        task, advance=1, description=f"[green]Added {Path(zinfo.filename).name} to {project_zip.name}")
+
+                # zlib releases the GIL, compress in worker threads while entries
+                # are written in order, bounding how many are held in memory.
+                # Stored and reused entries are copied at write time instead
+                workers = os.cpu_count() or 1
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    pending = deque()
+                    for file in project_files:
+                        arcname = os.path.relpath(file, project_dir)
+                        zinfo = zipfile.ZipInfo.from_file(file, arcname)
+                        previous = previous_entries.get(zinfo.filename)
+
+                        if previous is not None and not zinfo.is_dir() and \
+                                previous.compress_type == compression and \
+                                (compression == zipfile.ZIP_STORED or reuse_deflated) and \
+                                previous.file_size == zinfo.file_size and \
+                                previous.date_time == DosDateTime(zinfo.date_time):
+                            zinfo.compress_type = previous.compress_type
+                            zinfo.CRC = previous.CRC
+                            zinfo.compress_size = previous.compress_size
+
+                            future = Future()
+                            future.set_result((zinfo, None))
+                            pending.append((future, str(project_zip),
+                                            ZipEntryDataOffset(previous_zip, previous)))
+                        else:
+                            future = executor.submit(
+                                CompressZipEntry, file, arcname, compression, compresslevel)
+                            pending.append((future, file, 0))
+
+                        if len(pending) >= 2 * workers:
+                            write_entry(pending.popleft())
+
+                    while pending:
+                        write_entry(pending.popleft())
+        except BaseException:
+            partial_zip.unlink(missing_ok=True)
+            raise
+        finally:
+            if previous_zip is not None:
+                previous_zip.close()
+
+        os.replace(partial_zip, project_zip)
 
         progress.update(
             task, description="[green]Project zipped")
@@ -115,16 +356,30 @@ def ZipProject(project_dir: Path, project_name: str) -> Path:
     return project_zip.resolve()
 
 
+# Resolved paths keyed by (path, sysroot), including every intermediate hop
+# so sibling links sharing part of a chain resolve without extra syscalls
+_resolve_cache = {}
+
+
 def ResolveWithRoot(path_to_resolve: Path, sysroot: Path) -> Path:
     current_path = Path(path_to_resolve)
+    root = str(sysroot)
+    hops = []
     # A limit to prevent infinite loops from circular symlinks
     for _ in range(100):
-        if not current_path.is_symlink():
+        key = (str(current_path), root)
+        resolved = _resolve_cache.get(key)
+        if resolved is not None:
+            break
+        hops.append(key)
+
+        try:
+            # It's a symlink, read its destination
+            link_destination = Path(os.readlink(current_path))
+        except OSError:
             # Not a symlink, we've found our final path
-            return current_path
-
-        # It's a symlink, read its destination
-        link_destination = current_path.readlink()
+            resolved = current_path
+            break
 
         if link_destination.is_absolute():
             # Absolute link: The path is relative to the sysroot
@@ -137,9 +392,204 @@ def ResolveWithRoot(path_to_resolve: Path, sysroot: Path) -> Path:
 
         # Normalize the path (e.g., collapse '..' components)
         current_path = Path(os.path.normpath(next_path))
+    else:
+        raise RecursionError(
+            "Too many symlink levels; circular symlink suspected.")
+
+    for key in hops:
+        _resolve_cache[key] = resolved
+
+    return resolved
+
+
+def StageBinary(src: Path, dst_dir: Path, mode: str = "link") -> Path:
+    dst = dst_dir / src.name
+    # Never write through a previously staged hardlink into the original
+    dst.unlink(missing_ok=True)
+
+    if mode == "link":
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            # Different filesystem or not allowed to link, try cloning
+            mode = "reflink"
+
+    if mode == "reflink" and hasattr(os, "copy_file_range"):
+        try:
+            # Lets the filesystem share the blocks (BTRFS, XFS) or copy them
+            # in the kernel without a round trip through user space
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                remaining = os.fstat(fsrc.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(
+                        fsrc.fileno(), fdst.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            dst.unlink(missing_ok=True)
+
+    shutil.copy2(src, dst)
+    return dst
+
+
+def ResolveTargetDependencies(target: Path, use_system_libs: bool, ld_path: List[Path], verbose: bool = False, auto_load_libs: bool = True) -> Tuple[List[Tuple[str, Path, bool, str, Tuple[str, ...]]], Dict[str, Optional[Path]]]:
+    import cle
+
+    with capture_cle_output(verbose):
+        ld = cle.Loader(target, auto_load_libs=auto_load_libs,
+                        use_system_libs=use_system_libs, ld_path=ld_path)
+
+    objects = []
+    for k, obj in ld.shared_objects.items():
+        abs_obj_path = Path(obj.binary).resolve()
+        if abs_obj_path.is_file():
+            objects.append((k, abs_obj_path, obj.is_main_bin,
+                            f"{obj.arch}, {obj.linking}, pic={obj.pic}, execstack={obj.execstack}",
+                            tuple(getattr(obj, "deps", ()))))
 
-    raise RecursionError(
-        "Too many symlink levels; circular symlink suspected.")
+    # Objects are keyed by what they provide, which may not be the DT_NEEDED
+    # name they were loaded for (e.g. no DT_SONAME), keep track of both
+    missing = ld.missing_dependencies
+    resolved = {}
+    for soname in ld.requested_names:
+        dep = ld.find_object(soname)
+        if dep is not None and dep.binary:
+            resolved[soname] = Path(dep.binary).resolve()
+        elif soname in missing:
+            resolved[soname] = None
+
+    return objects, resolved
+
+
+# Shared objects resolved by cle keyed by (DT_NEEDED name, target arch and
+# search dirs), mapped to their name, path (None when cle could not find them),
+# description and their own DT_NEEDED
+_soname_cache = {}
+
+
+def ElfArch(header: bytes) -> Optional[Tuple[int, int, int]]:
+    # ELF class, data encoding and e_machine, which libraries have to match
+    if len(header) < 20 or header[:4] != b"\x7fELF":
+        return None
+
+    (machine,) = struct.unpack("<H" if header[5] == 1 else ">H", header[18:20])
+
+    return header[4], header[5], machine
+
+
+def SonameCacheScope(target: Path, ld_path: List[Path], arch: Tuple[int, int, int]) -> Tuple:
+    # cle also looks up libraries next to the main binary, and only picks
+    # those matching its arch (the system search path also depends on it)
+    return (arch, str(target.parent)) + tuple(str(x) for x in ld_path)
+
+
+def CacheTargetDependencies(target: Path, ld_path: List[Path], objects: List, resolved: Dict[str, Optional[Path]]) -> None:
+    try:
+        with open(target, "rb") as fh:
+            arch = ElfArch(fh.read(20))
+    except OSError:
+        arch = None
+    if arch is None:
+        return
+
+    scope = SonameCacheScope(target, ld_path, arch)
+    libraries = {abs_obj_path: (k, abs_obj_path, description, needed)
+                 for k, abs_obj_path, is_main_bin, description, needed in objects if not is_main_bin}
+
+    for soname, abs_obj_path in resolved.items():
+        if abs_obj_path is None:
+            _soname_cache.setdefault(
+                (soname, scope), (None, None, "", ()))
+        elif abs_obj_path in libraries:
+            _soname_cache[(soname, scope)] = libraries[abs_obj_path]
+
+
+def ResolveCachedDependencies(target: Path, ld_path: List[Path]) -> Optional[Tuple[List[Tuple[str, Path, bool, str, Tuple[str, ...]]], Dict[str, Optional[Path]]]]:
+    from archinfo import ArchNotFound, arch_from_id
+    from elftools.common.exceptions import ELFError
+    from elftools.elf.dynamic import DynamicSection
+    from elftools.elf.elffile import ELFFile
+
+    try:
+        with open(target, "rb") as fh:
+            elf_arch = ElfArch(fh.read(20))
+            if elf_arch is None:
+                return None
+            fh.seek(0)
+            elf = ELFFile(fh)
+
+            needed = []
+            for section in elf.iter_sections():
+                if isinstance(section, DynamicSection):
+                    for tag in section.iter_tags():
+                        if tag.entry.d_tag == "DT_NEEDED":
+                            needed.append(tag.needed)
+                        elif tag.entry.d_tag in ("DT_RPATH", "DT_RUNPATH"):
+                            # Search paths specific to this target, leave it to cle
+                            return None
+
+            # Same description cle would give for the main binary
+            try:
+                arch = arch_from_id(
+                    elf["e_machine"], "le" if elf.little_endian else "be", elf.elfclass)
+            except ArchNotFound:
+                arch = elf.get_machine_arch()
+
+            segments = {x.header.p_type: x for x in elf.iter_segments()}
+            linking = "dynamic" if "PT_DYNAMIC" in segments else "static"
+            pic = elf.header.e_type == "ET_DYN"
+            execstack = "PT_GNU_STACK" not in segments or bool(
+                segments["PT_GNU_STACK"].header.p_flags & 1)
+            description = f"{arch}, {linking}, pic={pic}, execstack={execstack}"
+    except (OSError, ELFError):
+        return None
+
+    scope = SonameCacheScope(target, ld_path, elf_arch)
+    objects = [(target.name, target.resolve(),
+                True, description, tuple(needed))]
+
+    # Only answer when the whole DT_NEEDED closure has been seen before
+    resolved = {}
+    loaded = set()
+    pending = list(needed)
+    while pending:
+        soname = pending.pop()
+        if soname in resolved:
+            continue
+
+        cached = _soname_cache.get((soname, scope))
+        if cached is None:
+            return None
+
+        k, abs_obj_path, so_description, so_needed = cached
+        if abs_obj_path is not None and abs_obj_path not in loaded:
+            loaded.add(abs_obj_path)
+            objects.append(
+                (k, abs_obj_path, False, so_description, so_needed))
+            pending.extend(so_needed)
+        resolved[soname] = abs_obj_path
+
+    return objects, resolved
+
+
+def DefaultZipLevel() -> int:
+    # argparse does not check defaults against choices
+    value = os.environ.get("DRAGONKICK_ZIP_LEVEL", "1")
+    try:
+        level = int(value)
+    except ValueError:
+        level = -1
+
+    if level not in range(10):
+        log_warning(
+            f"Ignoring invalid DRAGONKICK_ZIP_LEVEL '{value}', using level 1")
+        return 1
+
+    return level
 
 
 def GetParser() -> argparse.ArgumentParser:
@@ -173,7 +623,7 @@ def GetParser() -> argparse.ArgumentParser:
         "--copy-to-project",
         action="store_true",
         default=False,
-        help="copy original targets/dependencies into the project tree",
+        help="save original targets/dependencies into the project tree, hardlinked by default (see --stage-mode)",
     )
 
     project_group.add_argument(
@@ -222,6 +672,13 @@ def GetParser() -> argparse.ArgumentParser:
         help="open project in Ghidra after kickstart",
     )
 
+    project_group.add_argument(
+        "--stage-mode",
+        choices=("link", "reflink", "copy"),
+        default="link",
+        help="how -c saves binaries: link hardlinks them falling back to reflink, reflink clones them falling back to copy (default: %(default)s)",
+    )
+
     project_group.add_argument(
         "-z",
         "--zip-project",
@@ -230,6 +687,22 @@ def GetParser() -> argparse.ArgumentParser:
         help="create a zip archive of the project tree",
     )
 
+    project_group.add_argument(
+        "--zip-level",
+        type=int,
+        choices=range(10),
+        default=DefaultZipLevel(),
+        metavar="{0-9}",
+        help="zip compression level, 0 stores files uncompressed for archiving with an outer compressor like bzip2 (default: %(default)s, or DRAGONKICK_ZIP_LEVEL)",
+    )
+
+    project_group.add_argument(
+        "--rezip",
+        action="store_true",
+        default=False,
+        help="rebuild the project zip instead of reusing unchanged files from the previous one",
+    )
+
     analysis_group = parser.add_argument_group("Analysis options")
 
     analysis_group.add_argument(
@@ -262,6 +735,21 @@ def GetParser() -> argparse.ArgumentParser:
         help="decompile and export functions code under project tree",
     )
 
+    analysis_group.add_argument(
+        "--decomp-timeout",
+        type=int,
+        default=60,
+        metavar="SECONDS",
+        help="give up decompiling a function after SECONDS, 0 waits forever (default: %(default)s)",
+    )
+
+    analysis_group.add_argument(
+        "--git",
+        action="store_true",
+        default=False,
+        help="track decompiled functions code in a git repository",
+    )
+
     path_group = parser.add_argument_group("Path options")
     path_group.add_argument(
         "-I",
@@ -331,6 +819,56 @@ def capture_cle_output(verbose=False):
             console.rule()
 
 
+@contextmanager
+def open_ghidra_project(project_dir: Path, project_name: str):
+    from ghidra.app.script import GhidraScriptUtil
+    from ghidra.base.project import GhidraProject
+    from ghidra.framework.model import ProjectLocator
+
+    # Same layout as pyghidra.open_program(nested_project_location=True)
+    project_location = project_dir / project_name
+    if ProjectLocator(str(project_location), project_name).exists():
+        project = GhidraProject.openProject(
+            str(project_location), project_name, True)
+    else:
+        project_location.mkdir(parents=True, exist_ok=True)
+        project = GhidraProject.createProject(
+            str(project_location), project_name, False)
+
+    GhidraScriptUtil.acquireBundleHostReference()
+    try:
+        yield project
+    finally:
+        GhidraScriptUtil.releaseBundleHostReference()
+        project.close()
+
+
+@contextmanager
+def open_program(project, binary: Path, analyze: bool):
+    from ghidra.program.flatapi import FlatProgramAPI
+    from ghidra.program.util import GhidraProgramUtilities
+    from java.io import File
+
+    if project.getRootFolder().getFile(binary.name):
+        program = project.openProgram("/", binary.name, False)
+    else:
+        program = project.importProgram(File(str(binary)))
+        if program is None:
+            raise RuntimeError(f"Ghidra failed to import '{binary}'")
+        project.saveAs(program, "/", binary.name, True)
+
+    try:
+        flat_api = FlatProgramAPI(program)
+        if analyze and GhidraProgramUtilities.shouldAskToAnalyze(program):
+            flat_api.analyzeAll(program)
+            GhidraProgramUtilities.markProgramAnalyzed(program)
+
+        yield flat_api
+    finally:
+        project.save(program)
+        project.close(program)
+
+
 def log_error(message: str):
     console.log(f"[bold red]ERROR:[/] {message}")
 
@@ -344,6 +882,9 @@ def main(options=None) -> Optional[int]:
         parser = GetParser()
         options = parser.parse_args(sys.argv[1:])
 
+    _resolve_cache.clear()
+    _soname_cache.clear()
+
     sysroot = Path(os.path.normpath(options.sysroot)).resolve()
 
     if not sysroot.is_dir():
@@ -351,22 +892,44 @@ def main(options=None) -> Optional[int]:
         return EX_NOINPUT
 
     targets = set()
+    target_ids = set()
     for target in options.targets:
         target = os.path.normpath(target)
         if sysroot == Path(os.path.sep):
-            target_path = Path(target).resolve()
+            # Symlinks are left to ResolveWithRoot, no need to resolve twice
+            target_path = os.path.abspath(target)
         else:
-            target_path = sysroot / target.lstrip(".").lstrip(os.path.sep)
-        target_ex = glob.glob(str(target_path))
+            target_path = os.path.join(
+                sysroot, target.lstrip(".").lstrip(os.path.sep))
+        # Same wildcards glob understands
+        if any(x in target_path for x in "*?["):
+            target_ex = glob.iglob(target_path, recursive=True)
+        else:
+            # Explicit path, no need to scan its directory. If it is
+            # missing it gets reported below like any other target
+            target_ex = [target_path]
         for ex in target_ex:
-            target_path = ResolveWithRoot(ex, sysroot)
-            if not target_path.is_file():
+            if os.path.islink(ex):
+                target_path = ResolveWithRoot(ex, sysroot)
+            else:
+                target_path = Path(ex)
+            try:
+                target_stat = os.stat(target_path)
+            except OSError:
+                target_stat = None
+            if target_stat is None or not stat.S_ISREG(target_stat.st_mode):
                 if options.ignore_missing:
                     log_warning(
                         f"Target {target_path} does not exist, skipping")
                     continue
                 log_error(f"Target {target_path} does not exist")
                 return EX_NOINPUT
+            # Paths are not canonicalized, the same binary can be reached
+            # through several of them (e.g. /bin and /usr/bin on merged /usr)
+            target_id = (target_stat.st_dev, target_stat.st_ino)
+            if target_id in target_ids:
+                continue
+            target_ids.add(target_id)
             targets.add(target_path)
 
     project_name = options.project_name
@@ -419,6 +982,13 @@ def main(options=None) -> Optional[int]:
             "GHIDRA_INSTALL_DIR", "/opt/ghidra"))
         os.environ["GHIDRA_INSTALL_DIR"] = str(ghidra_install_dir)
 
+    import pyghidra
+    from rich.console import Group
+    from rich.live import Live
+    from rich.panel import Panel
+    from rich.progress import Progress, TextColumn, BarColumn, SpinnerColumn, TimeElapsedColumn, MofNCompleteColumn
+    from rich.status import Status
+
     with console.status(f"[bold][green]:dragon: Starting PyGhidra from {ghidra_install_dir} :dragon:") as status:
         with capture_ghidra_output():
             try:
@@ -471,33 +1041,72 @@ def main(options=None) -> Optional[int]:
 
         deps = set()
 
-        for target in list(targets)[:]:
-            with capture_cle_output(options.verbose):
+        # cle spends most of its time in Python, resolve several targets in
+        # separate processes, spawned rather than forked from the JVM process
+        workers = min(len(targets), os.cpu_count() or 1)
+        if workers > 1:
+            executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(max_workers=1)
+
+        # Only the targets themselves are needed when dependencies are skipped
+        auto_load_libs = not options.skip_dependency_import
+
+        def resolve_target(target):
+            future = Future()
+            try:
+                cached = None
+                if auto_load_libs:
+                    cached = ResolveCachedDependencies(target, ld_path)
+                if cached is None:
+                    return executor.submit(ResolveTargetDependencies, target, use_system_libs, ld_path, options.verbose, auto_load_libs)
+                future.set_result(cached)
+            except Exception as e:
+                # BrokenProcessPool once a worker died, report it for this
+                # target like any other resolution failure
+                future.set_exception(e)
+            return future
+
+        with executor:
+            remaining = deque(targets)
+            resolving = deque()
+            while remaining or resolving:
+                # Keep no more targets in flight than workers, so the following
+                # ones can be answered from the libraries resolved so far
+                while remaining and len(resolving) < workers:
+                    target = remaining.popleft()
+                    resolving.append((target, resolve_target(target)))
+
+                target, future = resolving.popleft()
                 try:
-                    ld = cle.Loader(target, auto_load_libs=True,
-                                    use_system_libs=use_system_libs, ld_path=ld_path)
+                    objects, resolved = future.result()
                 except Exception as e:
                     log_error(f"{e}")
                     targets.remove(target)
                     continue
 
-                for k, obj in ld.shared_objects.items():
-                    abs_obj_path = Path(obj.binary).resolve()
-                    if abs_obj_path.is_file():
-                        if obj.is_main_bin:
+                if auto_load_libs:
+                    CacheTargetDependencies(
+                        target, ld_path, objects, resolved)
+
+                for k, abs_obj_path, is_main_bin, description, _ in objects:
+                    if is_main_bin:
+                        if options.verbose:
+                            console.log(
+                                f"Target {abs_obj_path}: {description}")
+                        if options.copy_to_project:
+                            StageBinary(abs_obj_path, bin_dir,
+                                        options.stage_mode)
+                    else:
+                        if not options.skip_dependency_import:
                             if options.verbose:
                                 console.log(
-                                    f"Target {abs_obj_path}: {obj.arch}, {obj.linking}, pic={obj.pic}, execstack={obj.execstack}")
+                                    f"Resolved [bold]{k}[/bold] to {abs_obj_path}")
                             if options.copy_to_project:
-                                shutil.copy2(abs_obj_path, bin_dir)
-                        else:
-                            if not options.skip_dependency_import:
-                                if options.verbose:
-                                    console.log(
-                                        f"Resolved [bold]{k}[/bold] to {abs_obj_path}")
-                                if options.copy_to_project:
-                                    shutil.copy2(abs_obj_path, lib_dir)
-                                deps.add(abs_obj_path)
+                                StageBinary(abs_obj_path, lib_dir,
+                                            options.stage_mode)
+                            deps.add(abs_obj_path)
 
         if not options.skip_dependency_import:
             console.log(
@@ -511,7 +1120,49 @@ def main(options=None) -> Optional[int]:
             log_error("No target to import")
             return EX_NOINPUT
 
-        if not options.skip_dependency_import and deps:
+        with open_ghidra_project(project_dir, project_name) as project:
+            if not options.skip_dependency_import and deps:
+                progress = Progress(
+                    SpinnerColumn(),
+                    TextColumn("[progress.description]{task.description}"),
+                    BarColumn(),
+                    MofNCompleteColumn(),
+                    TimeElapsedColumn(),
+                )
+                status = Status("Importing dependencies...")
+                live_group = Group(Panel(progress), Panel(status))
+
+                with Live(live_group, refresh_per_second=10, auto_refresh=console.is_terminal) as live:
+                    task = progress.add_task(
+                        "[green]Importing dependencies...", total=len(deps))
+                    for dep in deps:
+                        if options.do_dependency_analysis:
+                            status.update(
+                                f"[green]:dragon: Analyzing [bold]{dep.name}[/bold] :dragon:")
+                        else:
+                            status.update(
+                                f"[green]Importing [bold]{dep.name}[/bold]")
+
+                        with open_program(project, dep, options.do_dependency_analysis) as flat_api:
+                            program = flat_api.getCurrentProgram()
+
+                            if options.do_dependency_analysis:
+                                status.update(
+                                    f"[green]:dragon: Analysis of [bold]{dep.name}[/bold] complete :dragon:")
+                            else:
+                                status.update(
+                                    f"[green]Imported [bold]{dep.name}[/bold], creation_date={program.getCreationDate()}, language_id={program.getLanguageID()}")
+
+                        progress.update(
+                            task, advance=1, description=f"[green]Imported [bold]{dep.name}[/bold]")
+
+                    progress.update(
+                        task, description="[green]Dependencies import complete")
+                    progress.stop()
+                    status.update("[green]All dependencies imported!")
+                    status.stop()
+                    live.refresh()
+
             progress = Progress(
                 SpinnerColumn(),
                 TextColumn("[progress.description]{task.description}"),
@@ -519,155 +1170,146 @@ def main(options=None) -> Optional[int]:
                 MofNCompleteColumn(),
                 TimeElapsedColumn(),
             )
-            status = Status("Importing dependencies...")
-            live_group = Group(Panel(progress), Panel(status))
+            progress_panel = Panel(progress)
+
+            status = Status("Importing targets...")
+            status_panel = Panel(status)
 
-            with Live(live_group, refresh_per_second=10) as live:
+            live_group = Group(progress_panel, status_panel)
+
+            # Decompilation updates the progress for every function, redraw
+            # it less often. Nothing is drawn until the end without a terminal
+            refresh_per_second = 4 if options.do_target_decompilation else 10
+            with Live(live_group, refresh_per_second=refresh_per_second, auto_refresh=console.is_terminal) as live:
                 task = progress.add_task(
-                    "[green]Importing dependencies...", total=len(deps))
-                for dep in deps:
-                    if options.do_dependency_analysis:
+                    "[green]Importing targets...", total=len(targets))
+
+                for target in targets:
+                    if options.skip_target_analysis:
+                        analyze_target = False
                         status.update(
-                            f"[green]:dragon: Analyzing [bold]{dep.name}[/bold] :dragon:")
+                            f"[green]Importing [bold]{target.name}[/bold]")
                     else:
+                        analyze_target = True
                         status.update(
-                            f"[green]Importing [bold]{dep.name}[/bold]")
+                            f"[green]:dragon: Analyzing [bold]{target.name}[/bold] :dragon:")
 
-                    with pyghidra.open_program(dep, analyze=options.do_dependency_analysis, project_location=project_dir, project_name=project_name, nested_project_location=True) as flat_api:
+                    with open_program(project, target, analyze_target) as flat_api:
                         program = flat_api.getCurrentProgram()
 
-                        if options.do_dependency_analysis:
+                        if analyze_target:
                             status.update(
-                                f"[green]:dragon: Analysis of [bold]{dep.name}[/bold] complete :dragon:")
+                                f"[green]:dragon: Analysis of [bold]{target.name}[/bold] complete :dragon:")
                         else:
                             status.update(
-                                f"[green]Imported [bold]{dep.name}[/bold], creation_date={program.getCreationDate()}, language_id={program.getLanguageID()}")
+                                f"[green]Imported [bold]{target.name}[/bold], creation_date={program.getCreationDate()}, language_id={program.getLanguageID()}")
 
                         progress.update(
-                            task, description=f"[green]Imported [bold]{dep.name}[/bold]")
+                            task, advance=1, description=f"[green]Imported [bold]{target.name}[/bold]")
+
+                        if options.do_target_decompilation:
+                            function_manager = program.getFunctionManager()
+                            functions = [
+                                x for x in function_manager.getFunctionsNoStubs(True) if not x.isThunk()]
+
+                            target_src = src_dir / target.name
+                            target_src.mkdir(parents=True, exist_ok=True)
+
+                            removed_files = set()
+                            with os.scandir(target_src) as entries:
+                                for entry in entries:
+                                    if entry.is_symlink():
+                                        os.unlink(entry.path)
+                                        removed_files.add(entry.name)
+
+                            status.stop()
+                            decomp_progress = Progress(
+                                SpinnerColumn(),
+                                TextColumn(
+                                    "[progress.description]{task.description}"),
+                                BarColumn(),
+                                MofNCompleteColumn(),
+                                TimeElapsedColumn(),
+                            )
+                            status_panel.renderable = decomp_progress
+
+                            decomp_task = decomp_progress.add_task(
+                                "[green]Decompiling functions...", total=len(functions))
+                            decompiled_functions = []
+                            decompiled_count = itertools.count()
+
+                            def save_function(decompiled):
+                                function, signature, code, filename, symlink = decompiled
 
-                    progress.update(task, advance=1)
+                                if signature is not None:
+                                    decompiled_functions.append(
+                                        (filename, str(code).encode(), symlink))
+
+                                # Function names fly by too fast to read anyway
+                                description = None
+                                if next(decompiled_count) & 63 == 0:
+                                    description = f"[green]Decompiled [bold]{function.getName()}[/bold]"
+                                decomp_progress.update(
+                                    decomp_task, advance=1, description=description)
+
+                            DecompileFunctions(
+                                program, functions, save_function, options.decomp_timeout)
+
+                            # Write sources once decompilation is over with raw
+                            # unbuffered I/O, one open/write/close per file,
+                            # relative to the source directory opened once
+                            created_files = []
+                            dirfd = os.open(target_src, os.O_RDONLY | os.O_DIRECTORY)
+                            try:
+                                for filename, code, symlink in decompiled_functions:
+                                    fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                                 0o666, dir_fd=dirfd)
+                                    try:
+                                        data = memoryview(code)
+                                        while data:
+                                            data = data[os.write(fd, data):]
+                                    finally:
+                                        os.close(fd)
+
+                                    os.symlink(filename, symlink, dir_fd=dirfd)
+
+                                    created_files.append(filename)
+                                    created_files.append(symlink)
+                            finally:
+                                os.close(dirfd)
+
+                            decomp_progress.update(
+                                decomp_task, description="[green]Decompilation complete")
+                            decomp_progress.stop()
+
+                            if options.git:
+                                import git
+
+                                target_repo = git.Repo.init(target_src)
+
+                                stale_files = removed_files.difference(
+                                    created_files)
+                                if stale_files:
+                                    target_repo.index.remove(
+                                        sorted(stale_files), ignore_unmatch=True)
+
+                                target_repo.index.add(created_files, write=True)
+                                target_repo.index.commit(
+                                    "Decompiled source refresh", skip_hooks=True)
+
+                        status_panel.renderable = status
 
                 progress.update(
-                    task, description="[green]Dependencies import complete")
+                    task, description="[green]Targets import complete")
                 progress.stop()
-                status.update("[green]All dependencies imported!")
+                status.update("[green]All targets imported!")
                 status.stop()
                 live.refresh()
 
-        progress = Progress(
-            SpinnerColumn(),
-            TextColumn("[progress.description]{task.description}"),
-            BarColumn(),
-            MofNCompleteColumn(),
-            TimeElapsedColumn(),
-        )
-        progress_panel = Panel(progress)
-
-        status = Status("Importing targets...")
-        status_panel = Panel(status)
-
-        live_group = Group(progress_panel, status_panel)
-
-        with Live(live_group, refresh_per_second=10) as live:
-            task = progress.add_task(
-                "[green]Importing targets...", total=len(targets))
-
-            for target in targets:
-                if options.skip_target_analysis:
-                    analyze_target = False
-                    status.update(
-                        f"[green]Importing [bold]{target.name}[/bold]")
-                else:
-                    analyze_target = True
-                    status.update(
-                        f"[green]:dragon: Analyzing [bold]{target.name}[/bold] :dragon:")
-
-                with pyghidra.open_program(target, analyze=analyze_target, project_location=project_dir, project_name=project_name, nested_project_location=True) as flat_api:
-                    program = flat_api.getCurrentProgram()
-
-                    progress.update(
-                        task, description=f"[green]Imported [bold]{target.name}[/bold]")
-
-                    if analyze_target:
-                        status.update(
-                            f"[green]:dragon: Analysis of [bold]{target.name}[/bold] complete :dragon:")
-                    else:
-                        status.update(
-                            f"[green]Imported [bold]{target.name}[/bold], creation_date={program.getCreationDate()}, language_id={program.getLanguageID()}")
-
-                    progress.update(task, advance=1)
-
-                    if options.do_target_decompilation:
-                        function_manager = program.getFunctionManager()
-                        functions = [
-                            x for x in function_manager.getFunctionsNoStubs(True)]
-
-                        decompiler = SetupDecompiler(program)
-
-                        target_src = src_dir / target.name
-                        target_src.mkdir(parents=True, exist_ok=True)
-                        target_repo = git.Repo.init(target_src)
-
-                        for x in target_src.iterdir():
-                            if x.is_symlink():
-                                x.unlink()
-
-                        status.stop()
-                        decomp_progress = Progress(
-                            SpinnerColumn(),
-                            TextColumn(
-                                "[progress.description]{task.description}"),
-                            BarColumn(),
-                            MofNCompleteColumn(),
-                            TimeElapsedColumn(),
-                        )
-                        status_panel.renderable = decomp_progress
-
-                        decomp_task = decomp_progress.add_task(
-                            "[green]Decompiling functions...", total=len(functions))
-                        for f in functions:
-                            if not f.isThunk():
-                                function, signature, code, filename, symlink = DecompileFunction(
-                                    f, decompiler)
-                                decomp_progress.update(
-                                    decomp_task, description=f"[green]Decompiled [bold]{f.getName()}[/bold]")
-
-                                if signature is not None:
-                                    function_src = target_src / filename
-                                    with open(function_src, "w") as fh:
-                                        fh.write(code)
-
-                                    function_link = target_src / symlink
-                                    function_link.symlink_to(filename)
-                            else:
-                                decomp_progress.update(
-                                    decomp_task, description=f"[green]Skipping thunk [bold]{f.getName()}[/bold]")
-
-                            decomp_progress.update(decomp_task, advance=1)
-
-                        decomp_progress.update(
-                            decomp_task, description="[green]Decompilation complete")
-                        decomp_progress.stop()
-
-                        target_repo.git.add(all=True)
-                        target_repo.index.commit("Decompiled source refresh")
-
-                        decompiler.dispose()
-
-                    status_panel.renderable = status
-
-            progress.update(
-                task, description="[green]Targets import complete")
-            progress.stop()
-            status.update("[green]All targets imported!")
-            status.stop()
-            live.refresh()
-
         if options.zip_project:
             try:
                 console.log(
-                    f"Project zip saved {ZipProject(project_dir, project_name)}")
+                    f"Project zip saved {ZipProject(project_dir, project_name, options.zip_level, options.rezip)}")
             except Exception as e:
                 log_error(f"Failed to zip {project_dir}")
                 log_error(f"{e}")
@@ -4,19 +4,126 @@
 # This software is released under the MIT License.
 # See the LICENSE file for more details.
 
+import atexit
+import errno
 import os
+import random
 import shutil
+import sys
+import tempfile
+import threading
+import types
 import unittest
+import uuid
+import zipfile
+import zlib
 
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from pathlib import Path
-
-from dragonkick.main import main, GetParser, EX_NOINPUT, EX_UNAVAILABLE, EX_CANTCREAT
+from typing import List
+from unittest.mock import MagicMock, patch
+
+from dragonkick import main as dragonkick_main
+from dragonkick.main import main, CacheTargetDependencies, CompressZipEntry, GetParser, ResolveCachedDependencies, ResolveTargetDependencies, StageBinary, ZipEntryDataOffset, ZipProject, ZIP_CHUNK_SIZE, EX_NOINPUT, EX_UNAVAILABLE, EX_CANTCREAT
+
+# Keep the Ghidra projects created by the tests in memory when possible
+TMP_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+# Boolean options, all off by default
+FLAGS = (
+    "copy_to_project",
+    "do_dependency_analysis",
+    "do_target_decompilation",
+    "force_import",
+    "force_remove",
+    "git",
+    "ignore_missing",
+    "rezip",
+    "skip_dependency_import",
+    "skip_target_analysis",
+    "start_ghidra",
+    "verbose",
+    "zip_project",
+)
+
+_removal_threads = []
+
+
+def _remove_tree(path: Path):
+    # Move the tree out of the way and delete it while the next tests run
+    trash = path.with_name(f".trash-{uuid.uuid4().hex}")
+    try:
+        os.rename(path, trash)
+    except FileNotFoundError:
+        return
+
+    thread = threading.Thread(
+        target=shutil.rmtree, args=(trash,), kwargs={"ignore_errors": True}, daemon=True)
+    thread.start()
+    _removal_threads.append(thread)
+
+
+@atexit.register
+def _join_removal_threads():
+    for thread in _removal_threads:
+        thread.join()
+
+
+@contextmanager
+def _fake_ghidra_project(project_dir: Path, project_name: str):
+    # Only leave the project file main() looks for once done
+    project_location = project_dir / project_name
+    project_location.mkdir(parents=True, exist_ok=True)
+    (project_location / f"{project_name}.gpr").touch()
+    yield MagicMock()
+
+
+@contextmanager
+def _fake_program(project, binary: Path, analyze: bool):
+    yield MagicMock()
+
+
+@contextmanager
+def _fake_ghidra_modules():
+    framework = types.ModuleType("ghidra.framework")
+    framework.Application = MagicMock()
+    modules = {"ghidra": types.ModuleType("ghidra"),
+               "ghidra.framework": framework}
+
+    # patch.dict() would also drop every module imported in the meantime,
+    # only swap these two and put back the real ones if already imported
+    previous = {x: sys.modules.get(x) for x in modules}
+    sys.modules.update(modules)
+    try:
+        yield
+    finally:
+        for name, module in previous.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+
+
+def mock_ghidra(test):
+    # For tests checking what dragonkick stages itself, run without the JVM
+    patches = [
+        patch("pyghidra.start", MagicMock()),
+        patch("pyghidra.started", MagicMock(return_value=True)),
+        _fake_ghidra_modules(),
+        patch("dragonkick.main.open_ghidra_project", _fake_ghidra_project),
+        patch("dragonkick.main.open_program", _fake_program),
+    ]
+    for p in patches:
+        test = p(test)
+    return test
 
 
 class TestDragonKickArgs(unittest.TestCase):
 
-    def setUp(self):
-        self.parser = GetParser()
+    @classmethod
+    def setUpClass(cls):
+        cls.parser = GetParser()
 
     def test_required_arguments(self):
         # Should fail without --project-name
@@ -51,23 +158,16 @@ class TestDragonKickArgs(unittest.TestCase):
     def test_boolean_flags(self):
         # Test defaults
         args = self.parser.parse_args(["-n", "my_project", "./sysroot/bin/ls"])
-        self.assertFalse(args.copy_to_project)
-        self.assertFalse(args.do_dependency_analysis)
-        self.assertFalse(args.do_target_decompilation)
-        self.assertFalse(args.force_import)
-        self.assertFalse(args.force_remove)
-        self.assertFalse(args.ignore_missing)
-        self.assertFalse(args.skip_dependency_import)
-        self.assertFalse(args.skip_target_analysis)
-        self.assertFalse(args.start_ghidra)
-        self.assertFalse(args.verbose)
-        self.assertFalse(args.zip_project)
+        self.assertEqual({x: getattr(args, x) for x in FLAGS},
+                         dict.fromkeys(FLAGS, False))
 
         # Test setting all flags to True
         args = self.parser.parse_args([
             "-n", "my_project", "./sysroot/bin/ls",
             "--skip-dependency-import",
             "--skip-target-analysis",
+            "--git",
+            "--rezip",
             "-F",               # force_remove
             "-I",               # ignore_missing
             "-a",               # do_dependency_analysis
@@ -78,17 +178,57 @@ class TestDragonKickArgs(unittest.TestCase):
             "-v",               # verbose
             "-z",               # zip_project
         ])
-        self.assertTrue(args.copy_to_project)
-        self.assertTrue(args.do_dependency_analysis)
-        self.assertTrue(args.do_target_decompilation)
-        self.assertTrue(args.force_import)
-        self.assertTrue(args.force_remove)
-        self.assertTrue(args.ignore_missing)
-        self.assertTrue(args.skip_dependency_import)
-        self.assertTrue(args.skip_target_analysis)
-        self.assertTrue(args.start_ghidra)
-        self.assertTrue(args.verbose)
-        self.assertTrue(args.zip_project)
+        self.assertEqual({x: getattr(args, x) for x in FLAGS},
+                         dict.fromkeys(FLAGS, True))
+
+    def test_decomp_timeout(self):
+        # Test default timeout
+        args = self.parser.parse_args(["-n", "my_project", "./sysroot/bin/ls"])
+        self.assertEqual(args.decomp_timeout, 60)
+
+        # Test disabling the timeout
+        args = self.parser.parse_args(
+            ["-n", "my_project", "-d", "--decomp-timeout", "0", "./sysroot/bin/ls"])
+        self.assertEqual(args.decomp_timeout, 0)
+
+    def test_stage_mode(self):
+        # Test default staging mode
+        args = self.parser.parse_args(["-n", "my_project", "./sysroot/bin/ls"])
+        self.assertEqual(args.stage_mode, "link")
+
+        args = self.parser.parse_args(
+            ["-n", "my_project", "-c", "--stage-mode", "copy", "./sysroot/bin/ls"])
+        self.assertEqual(args.stage_mode, "copy")
+
+        # Should fail with an unknown mode
+        with self.assertRaises(SystemExit):
+            self.parser.parse_args(
+                ["-n", "my_project", "--stage-mode", "move", "./sysroot/bin/ls"])
+
+    def test_zip_level(self):
+        # Test default compression level, the default is read from the
+        # environment when the parser is built
+        with patch.dict(os.environ):
+            os.environ.pop("DRAGONKICK_ZIP_LEVEL", None)
+            args = GetParser().parse_args(["-n", "my_project", "./sysroot/bin/ls"])
+        self.assertEqual(args.zip_level, 1)
+
+        # Test the default from the environment, invalid ones fall back to 1
+        for value, level in (("9", 9), ("12", 1), ("fast", 1)):
+            with patch.dict(os.environ, {"DRAGONKICK_ZIP_LEVEL": value}):
+                args = GetParser().parse_args(
+                    ["-n", "my_project", "./sysroot/bin/ls"])
+            self.assertEqual(args.zip_level, level)
+
+        # Test storing files uncompressed
+        args = self.parser.parse_args(
+            ["-n", "my_project", "-z", "--zip-level", "0", "./sysroot/bin/ls"])
+        self.assertEqual(args.zip_level, 0)
+
+        # Should fail with an invalid level
+        with self.assertRaises(SystemExit):
+            self.parser.parse_args(
+                ["-n", "my_project", "--zip-level", "10", "./sysroot/bin/ls"])
 
     def test_path_options(self):
         # Test default sysroot
@@ -106,32 +246,32 @@ class TestDragonKickArgs(unittest.TestCase):
         self.assertEqual(args.ghidra_install_dir, Path("/opt/ghidra"))
 
 
-class TestMainFunction(unittest.TestCase):
-    def setUp(self):
-        os.environ["GHIDRA_INSTALL_DIR"] = "/opt/ghidra"
-
-        self.project_dir = Path("/tmp/test_project")
-        self.bin_dir = self.project_dir / "bin"
-        self.lib_dir = self.project_dir / "lib"
-        self.src_dir = self.project_dir / "src"
-        self.project_zip = self.project_dir.parent / "my_project.zip"
-
-        if self.project_dir.exists():
-            shutil.rmtree(self.project_dir)
+class TestMainValidation(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.parser = GetParser()
+        cls.sysroot = Path("./tests/sysroot")
+        cls.tgt_ls = str(cls.sysroot / "bin" / "ls")
+        cls.tgt_missing = str(cls.sysroot / "bin" / "MISSING")
 
-        if self.project_zip.is_file():
-            self.project_zip.unlink()
+        # Invalid options are rejected before anything is written there
+        cls.project_dir = Path(tempfile.mkdtemp(dir=TMP_DIR)) / "test_project"
 
-        self.sysroot = Path("./tests/sysroot")
+    @classmethod
+    def tearDownClass(cls):
+        _remove_tree(cls.project_dir.parent)
 
-        self.parser = GetParser()
+    def setUp(self):
+        environ = patch.dict(os.environ, {"GHIDRA_INSTALL_DIR": "/opt/ghidra"})
+        environ.start()
+        self.addCleanup(environ.stop)
 
     def test_invalid_ghidra_install_dir(self):
         args = self.parser.parse_args([
             "-G", "/opt/invalid_ghidra",
             "-n", "my_project",
             "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/ls"
+            self.tgt_ls
         ])
 
         ret_code = main(args)
@@ -142,7 +282,7 @@ class TestMainFunction(unittest.TestCase):
             "-R", "/opt/invalid_sysroot",
             "-n", "my_project",
             "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/ls"
+            self.tgt_ls
         ])
 
         ret_code = main(args)
@@ -152,29 +292,96 @@ class TestMainFunction(unittest.TestCase):
         args = self.parser.parse_args([
             "-n", "my_project",
             "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/MISSING"
+            self.tgt_missing
         ])
 
         ret_code = main(args)
         self.assertEqual(ret_code, EX_NOINPUT)
 
+
+class TestMainFunction(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.parser = GetParser()
+        cls.sysroot = Path("./tests/sysroot")
+        cls.tgt_ls = str(cls.sysroot / "bin" / "ls")
+        cls.tgt_missing = str(cls.sysroot / "bin" / "MISSING")
+        cls.golden_dir = None
+
+        # Every target of the sysroot, only test_multiple_targets_glob
+        # leaves their expansion to main()
+        cls._sysroot_bins = [
+            str(x) for x in sorted((cls.sysroot / "bin").iterdir())]
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.golden_dir is not None:
+            _remove_tree(cls.golden_dir.parent)
+
+    def _args(self, *extra):
+        return ["-n", "my_project", "-o", str(self.project_dir), *extra, self.tgt_ls]
+
+    def _count_files(self, path: str) -> int:
+        with os.scandir(path) as entries:
+            return sum(1 for x in entries if x.is_file())
+
+    def _copy_golden_project(self):
+        cls = type(self)
+
+        # Import the target the first time a test needs an existing project,
+        # tests work on a copy of it
+        if cls.golden_dir is None:
+            golden_dir = Path(tempfile.mkdtemp(dir=TMP_DIR)) / "test_project"
+            args = self.parser.parse_args([
+                "-n", "my_project",
+                "-o", str(golden_dir),
+                self.tgt_ls
+            ])
+            # Only remember the project once imported, so that a failing
+            # import is raised again by the next test needing it
+            try:
+                cls.golden_ret_code = main(args)
+            except BaseException:
+                _remove_tree(golden_dir.parent)
+                raise
+            cls.golden_dir = golden_dir
+
+        self.assertEqual(cls.golden_ret_code, 0)
+        shutil.copytree(cls.golden_dir, self.project_dir)
+
+    def setUp(self):
+        # main() exports GHIDRA_INSTALL_DIR, restore the environment afterwards
+        environ = patch.dict(os.environ, {"GHIDRA_INSTALL_DIR": "/opt/ghidra"})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+        tmp_dir = tempfile.mkdtemp(dir=TMP_DIR)
+        self.addCleanup(_remove_tree, Path(tmp_dir))
+
+        # Only listed through os.scandir, plain strings are enough
+        project_dir = os.path.join(tmp_dir, "test_project")
+        self.bin_dir = os.path.join(project_dir, "bin")
+        self.lib_dir = os.path.join(project_dir, "lib")
+        self.src_dir = os.path.join(project_dir, "src")
+
+        self.project_dir = Path(project_dir)
+        self.project_zip = Path(tmp_dir, "my_project.zip")
+
+    @mock_ghidra
     def test_single_target(self):
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args())
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
+    @mock_ghidra
     def test_single_target_path_normalized(self):
         path_to_norm = self.project_dir / ".." / self.project_dir.name
 
         args = self.parser.parse_args([
             "-n", "my_project",
             "-o", str(path_to_norm),
-            f"{self.sysroot}/bin/ls"
+            self.tgt_ls
         ])
 
         ret_code = main(args)
@@ -188,110 +395,62 @@ class TestMainFunction(unittest.TestCase):
         (self.project_dir / "my_project").mkdir(parents=True)
         (self.project_dir / "my_project" / "my_project.gpr").touch()
 
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args())
 
         ret_code = main(args)
         self.assertEqual(ret_code, EX_CANTCREAT)
 
     def test_single_target_force_import(self):
-        # Create the project
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/ls"
-        ])
-
-        ret_code = main(args)
-        self.assertEqual(ret_code, 0)
+        self._copy_golden_project()
 
         # Run again with -f
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            "-f",
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args("-f"))
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
     def test_single_target_force_remove(self):
-        # Create the project
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/ls"
-        ])
-
-        ret_code = main(args)
-        self.assertEqual(ret_code, 0)
+        self._copy_golden_project()
 
         # Run again with -F
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            "-F",
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args("-F"))
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
+    @mock_ghidra
     def test_single_target_skip_analysis(self):
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            "--skip-target-analysis",
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args("--skip-target-analysis"))
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
     def test_single_target_decompile(self):
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            "-d",
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args("-d"))
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
         # Some decompiled source should be there
-        src_dir = self.src_dir / "ls"
-        sources = [x for x in src_dir.iterdir() if x.is_file()]
-        self.assertGreaterEqual(len(sources), 1)
+        with os.scandir(os.path.join(self.src_dir, "ls")) as entries:
+            self.assertTrue(any(x.is_file() for x in entries))
 
     def test_single_target_dep_analysis(self):
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            "-a",
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args("-a"))
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
+    @mock_ghidra
     def test_single_target_zip(self):
-        args = self.parser.parse_args([
-            "-n", "my_project",
-            "-o", str(self.project_dir),
-            "-z",
-            f"{self.sysroot}/bin/ls"
-        ])
+        args = self.parser.parse_args(self._args("-z"))
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
         self.assertTrue(self.project_zip.is_file())
 
+    @mock_ghidra
     def test_single_target_with_sysroot_and_copy(self):
         args = self.parser.parse_args([
             "-R", f"{self.sysroot}",
@@ -304,22 +463,21 @@ class TestMainFunction(unittest.TestCase):
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 1)
-
-        libs = [x for x in self.lib_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(libs), 3)
+        self.assertEqual(self._count_files(self.bin_dir), 1)
+        self.assertEqual(self._count_files(self.lib_dir), 3)
 
+    @mock_ghidra
     def test_multiple_targets(self):
         args = self.parser.parse_args([
             "-n", "my_project",
             "-o", str(self.project_dir),
-            f"{self.sysroot}/bin/ls", f"{self.sysroot}/bin/cp",
+            *self._sysroot_bins,
         ])
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
+    @mock_ghidra
     def test_multiple_targets_glob(self):
         args = self.parser.parse_args([
             "-n", "my_project",
@@ -331,23 +489,23 @@ class TestMainFunction(unittest.TestCase):
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 2)
+        self.assertEqual(self._count_files(self.bin_dir), 2)
 
+    @mock_ghidra
     def test_multiple_targets_ignore_missing(self):
         args = self.parser.parse_args([
             "-n", "my_project",
             "-o", str(self.project_dir),
             "-cI",
-            f"{self.sysroot}/bin/ls", f"{self.sysroot}/bin/cp", f"{self.sysroot}/bin/MISSING",
+            *self._sysroot_bins, self.tgt_missing,
         ])
 
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 2)
+        self.assertEqual(self._count_files(self.bin_dir), 2)
 
+    @mock_ghidra
     def test_multiple_targets_with_sysroot_and_copy(self):
         args = self.parser.parse_args([
             "-R", f"{self.sysroot}",
@@ -360,12 +518,10 @@ class TestMainFunction(unittest.TestCase):
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 2)
-
-        libs = [x for x in self.lib_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(libs), 5)
+        self.assertEqual(self._count_files(self.bin_dir), 2)
+        self.assertEqual(self._count_files(self.lib_dir), 5)
 
+    @mock_ghidra
     def test_multiple_targets_with_sysroot_skip_deps(self):
         args = self.parser.parse_args([
             "-R", f"{self.sysroot}",
@@ -379,12 +535,49 @@ class TestMainFunction(unittest.TestCase):
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 2)
+        self.assertEqual(self._count_files(self.bin_dir), 2)
+        self.assertEqual(self._count_files(self.lib_dir), 0)
+
+    @mock_ghidra
+    def test_multiple_targets_same_binary(self):
+        # Merged /usr layout, /bin/ls and /usr/bin/ls are the same binary
+        sysroot = self.project_dir.parent / "sysroot"
+        (sysroot / "usr").mkdir(parents=True)
+        (sysroot / "usr" / "bin").symlink_to((self.sysroot / "bin").resolve())
+        (sysroot / "bin").symlink_to("usr/bin")
+
+        args = self.parser.parse_args([
+            "-R", str(sysroot),
+            "-n", "my_project",
+            "-o", str(self.project_dir),
+            "--skip-dependency-import",
+            "/bin/ls", "/usr/bin/ls"
+        ])
+
+        with patch("dragonkick.main.open_program", wraps=_fake_program) as open_program:
+            ret_code = main(args)
+        self.assertEqual(ret_code, 0)
+        self.assertEqual(open_program.call_count, 1)
+
+    @mock_ghidra
+    def test_multiple_targets_broken_process_pool(self):
+        args = self.parser.parse_args([
+            "-R", f"{self.sysroot}",
+            "-n", "my_project",
+            "-o", str(self.project_dir),
+            "/bin/ls", "/bin/cp"
+        ])
 
-        libs = [x for x in self.lib_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(libs), 0)
+        # Once a worker died the pool refuses every following target, which
+        # should be reported as failing to resolve
+        with patch("os.cpu_count", return_value=2), \
+                patch("dragonkick.main.ResolveCachedDependencies", return_value=None), \
+                patch("concurrent.futures.ProcessPoolExecutor.submit",
+                      side_effect=BrokenProcessPool("A child process terminated abruptly")):
+            ret_code = main(args)
+        self.assertEqual(ret_code, EX_NOINPUT)
 
+    @mock_ghidra
     def test_multiple_targets_with_sysroot_remove_existing_bins(self):
         # Copy two targets
         args = self.parser.parse_args([
@@ -398,11 +591,8 @@ class TestMainFunction(unittest.TestCase):
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 2)
-
-        libs = [x for x in self.lib_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(libs), 5)
+        self.assertEqual(self._count_files(self.bin_dir), 2)
+        self.assertEqual(self._count_files(self.lib_dir), 5)
 
         # Remove and then copy a single target this time
         args = self.parser.parse_args([
@@ -416,11 +606,8 @@ class TestMainFunction(unittest.TestCase):
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 1)
-
-        libs = [x for x in self.lib_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(libs), 3)
+        self.assertEqual(self._count_files(self.bin_dir), 1)
+        self.assertEqual(self._count_files(self.lib_dir), 3)
 
     def test_multiple_targets_with_sysroot_and_many_options(self):
         args = self.parser.parse_args([
@@ -436,12 +623,212 @@ class TestMainFunction(unittest.TestCase):
         ret_code = main(args)
         self.assertEqual(ret_code, 0)
 
-        bins = [x for x in self.bin_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(bins), 2)
+        self.assertEqual(self._count_files(self.bin_dir), 2)
 
         # --skip-dependency-import
-        libs = [x for x in self.lib_dir.iterdir() if x.is_file()]
-        self.assertEqual(len(libs), 0)
+        self.assertEqual(self._count_files(self.lib_dir), 0)
+
+
+
+class TestZipProject(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.mkdtemp(dir=TMP_DIR)
+        self.addCleanup(_remove_tree, Path(tmp_dir))
+
+        self.project_dir = Path(tmp_dir, "test_project")
+        (self.project_dir / "sub").mkdir(parents=True)
+        (self.project_dir / "empty").mkdir()
+
+        rng = random.Random(0)
+        self.files = {
+            "notes.txt": b"dragonkick\n",
+            "sub/words.txt": " ".join(
+                f"word{rng.randrange(1000)}" for _ in range(50000)).encode(),
+        }
+        for name, data in self.files.items():
+            (self.project_dir / name).write_bytes(data)
+
+    def _write_file(self, name: str, data: bytes):
+        self.files[name] = data
+        (self.project_dir / name).write_bytes(data)
+
+    def _assert_zip_matches(self, project_zip: Path):
+        with zipfile.ZipFile(project_zip) as zipf:
+            self.assertIsNone(zipf.testzip())
+            contents = {x.filename: zipf.read(x)
+                        for x in zipf.infolist() if not x.is_dir()}
+            dirs = [x.filename for x in zipf.infolist() if x.is_dir()]
+
+        self.assertEqual(contents, self.files)
+        # Only empty directories get an entry of their own
+        self.assertEqual(dirs, ["empty/"])
+
+    def _raw_entry(self, project_zip: Path, name: str) -> bytes:
+        with zipfile.ZipFile(project_zip) as zipf:
+            zinfo = zipf.getinfo(name)
+            offset = ZipEntryDataOffset(zipf, zinfo)
+        with open(project_zip, "rb") as fh:
+            fh.seek(offset)
+            return fh.read(zinfo.compress_size)
+
+    def test_zip_levels(self):
+        for level in (0, 1, 9):
+            with self.subTest(level=level):
+                project_zip = ZipProject(
+                    self.project_dir, "my_project", level, rezip=True)
+                self.assertEqual(
+                    project_zip, (self.project_dir.parent / "my_project.zip").resolve())
+                self.assertFalse(
+                    project_zip.with_name("my_project.zip.part").exists())
+                self._assert_zip_matches(project_zip)
+
+    def test_zip_stored_large_files(self):
+        # Stored data is copied from the files in several sendfile() calls
+        self._write_file("sub/blob.bin", os.urandom(ZIP_CHUNK_SIZE * 2 + 123))
+        self._assert_zip_matches(ZipProject(self.project_dir, "my_project", 0))
+
+        # Same through the fallback for platforms without sendfile()
+        with patch("os.sendfile", side_effect=OSError(errno.EINVAL, "Invalid argument")):
+            self._assert_zip_matches(ZipProject(
+                self.project_dir, "my_project", 0, rezip=True))
+
+    def test_zip_reuse(self):
+        self._write_file("sub/blob.bin", os.urandom(ZIP_CHUNK_SIZE * 2 + 123))
+
+        for level in (0, 1):
+            with self.subTest(level=level):
+                ZipProject(self.project_dir, "my_project", level, rezip=True)
+                self._write_file(
+                    "notes.txt", self.files["notes.txt"] + f"level {level}\n".encode())
+
+                # Only the changed file is compressed again, the other
+                # entries are copied from the previous zip
+                with patch("dragonkick.main.CompressZipEntry", wraps=CompressZipEntry) as compress:
+                    project_zip = ZipProject(
+                        self.project_dir, "my_project", level)
+                compressed = [x.args[1] for x in compress.call_args_list]
+                self.assertEqual(compressed, ["notes.txt", "empty"])
+                self._assert_zip_matches(project_zip)
+
+    def test_zip_level_change(self):
+        project_zip = ZipProject(self.project_dir, "my_project", 1)
+        level_1 = self._raw_entry(project_zip, "sub/words.txt")
+
+        # Unchanged files must not keep their level 1 data
+        project_zip = ZipProject(self.project_dir, "my_project", 9)
+        level_9 = self._raw_entry(project_zip, "sub/words.txt")
+        self.assertNotEqual(level_9, level_1)
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        self.assertEqual(
+            level_9, compressor.compress(self.files["sub/words.txt"]) + compressor.flush())
+        self._assert_zip_matches(project_zip)
+
+
+
+class TestStageBinary(unittest.TestCase):
+    def setUp(self):
+        tmp_dir = Path(tempfile.mkdtemp(dir=TMP_DIR))
+        self.addCleanup(_remove_tree, tmp_dir)
+
+        self.src = tmp_dir / "ls"
+        self.src.write_bytes(b"\x7fELF" + os.urandom(4096))
+        self.src.chmod(0o755)
+
+        self.dst_dir = tmp_dir / "bin"
+        self.dst_dir.mkdir()
+
+    def _assert_staged(self, dst: Path, linked: bool):
+        self.assertEqual(dst, self.dst_dir / "ls")
+        self.assertEqual(dst.read_bytes(), self.src.read_bytes())
+        self.assertEqual(dst.stat().st_mode, self.src.stat().st_mode)
+        self.assertEqual(os.path.samefile(dst, self.src), linked)
+
+    def test_link(self):
+        self._assert_staged(StageBinary(self.src, self.dst_dir, "link"), True)
+
+        # Staging again replaces the link instead of writing through it
+        self._assert_staged(StageBinary(self.src, self.dst_dir, "copy"), False)
+        self.assertEqual(self.src.stat().st_nlink, 1)
+
+    def test_link_cross_device(self):
+        with patch("os.link", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")):
+            self._assert_staged(
+                StageBinary(self.src, self.dst_dir, "link"), False)
+
+    def test_reflink(self):
+        self._assert_staged(
+            StageBinary(self.src, self.dst_dir, "reflink"), False)
+
+    def test_copy_fallback(self):
+        with patch("os.link", side_effect=OSError(errno.EXDEV, "Invalid cross-device link")), \
+                patch("os.copy_file_range", side_effect=OSError(errno.EXDEV, "Invalid cross-device link"), create=True), \
+                patch("shutil.copy2", wraps=shutil.copy2) as copy2:
+            self._assert_staged(
+                StageBinary(self.src, self.dst_dir, "link"), False)
+        copy2.assert_called_once_with(self.src, self.dst_dir / "ls")
+
+
+class TestDependencyResolution(unittest.TestCase):
+    def setUp(self):
+        dragonkick_main._soname_cache.clear()
+        self.addCleanup(dragonkick_main._soname_cache.clear)
+
+    def _assert_cached_like_cle(self, cached_target: Path, target: Path, ld_path: List[Path]):
+        # Nothing known about the libraries of the target yet
+        self.assertIsNone(ResolveCachedDependencies(target, ld_path))
+
+        objects, resolved = ResolveTargetDependencies(
+            cached_target, False, ld_path)
+        CacheTargetDependencies(cached_target, ld_path, objects, resolved)
+
+        objects, resolved = ResolveTargetDependencies(target, False, ld_path)
+        cached_objects, cached_resolved = ResolveCachedDependencies(
+            target, ld_path)
+        self.assertEqual(sorted(cached_objects), sorted(objects))
+        self.assertEqual(cached_resolved, resolved)
+
+        return objects, resolved
+
+    def test_cached_dependencies(self):
+        sysroot = Path("./tests/sysroot").resolve()
+        target = sysroot / "bin" / "ls"
+        self._assert_cached_like_cle(
+            target, target, [sysroot, sysroot / "lib"])
+
+    def test_cached_dependencies_without_soname(self):
+        # a and b both need libfoo.so.1, a symlink to libfoo.so.1.2.3 which
+        # has no DT_SONAME, so cle names it after the file it loaded
+        sysroot = Path("./tests/sysroot-nosoname").resolve()
+        objects, resolved = self._assert_cached_like_cle(
+            sysroot / "bin" / "a", sysroot / "bin" / "b", [sysroot / "lib"])
+
+        self.assertEqual([x[0] for x in objects if not x[2]], ["libfoo.so.1.2.3"])
+        self.assertEqual(
+            resolved, {"libfoo.so.1": sysroot / "lib" / "libfoo.so.1.2.3"})
+
+    def test_cached_dependencies_per_arch(self):
+        # a32 is a 32-bit a, its libfoo.so.1 only comes from lib32
+        sysroot = Path("./tests/sysroot-nosoname").resolve()
+        ld_path = [sysroot / "lib", sysroot / "lib32"]
+
+        objects, resolved = ResolveTargetDependencies(
+            sysroot / "bin" / "a", False, ld_path)
+        CacheTargetDependencies(
+            sysroot / "bin" / "a", ld_path, objects, resolved)
+
+        # The 64-bit libfoo.so.1 is of no use to it
+        self._assert_cached_like_cle(
+            sysroot / "bin" / "a32", sysroot / "bin" / "a32", ld_path)
+
+    def test_cached_missing_dependencies(self):
+        # Without the lib directory libfoo.so.1 cannot be found
+        sysroot = Path("./tests/sysroot-nosoname").resolve()
+        objects, resolved = self._assert_cached_like_cle(
+            sysroot / "bin" / "a", sysroot / "bin" / "b", [])
+
+        self.assertEqual([x for x in objects if not x[2]], [])
+        self.assertEqual(resolved, {"libfoo.so.1": None})
 
 
 if __name__ == "__main__":